@@ -1,14 +1,32 @@
 import os
+import json
 import time
+import atexit
+import socket
+import heapq
+import queue
 import random
+import secrets
+import itertools
 import threading
+import signal
 import sqlite3
+import contextvars
+from collections import namedtuple, deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
 from typing import Optional, Dict, Any, List, Tuple
 
+import requests
 import telebot
-from telebot import types
+from cachetools import TTLCache, cached
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from telebot import apihelper, types
 from telebot.apihelper import ApiTelegramException
+from telebot.handler_backends import BaseMiddleware
 
 
 # =========================
@@ -35,7 +53,81 @@ if not ADMIN_IDS:
     ADMIN_IDS = {8311003582}
 
 KZ_TZ = timezone(timedelta(hours=5))
-bot = telebot.TeleBot(TOKEN, parse_mode="HTML")
+
+class ChatOrderedTeleBot(telebot.TeleBot):
+    """Апдейт целиком (middleware, фильтры, хендлер) выполняется в очереди своего чата:
+    внутри чата — строго по порядку, разные чаты — параллельно (см. PER-CHAT QUEUES)."""
+
+    def process_new_updates(self, updates: List[types.Update]):
+        for update in updates:
+            # offset для getUpdates двигаем сразу — сами апдейты обработаются позже
+            if update.update_id > self.last_update_id:
+                self.last_update_id = update.update_id
+            chat_id = update_chat_id(update)
+            if chat_id is None:
+                self.dispatch_update(update)
+            else:
+                enqueue_update(chat_id, update)
+
+    def dispatch_update(self, update: types.Update):
+        # threaded=False: telebot выполняет всё прямо в вызывающем потоке
+        super().process_new_updates([update])
+
+bot = ChatOrderedTeleBot(TOKEN, parse_mode="HTML", use_class_middlewares=True, threaded=False)
+
+# одна keep-alive сессия на все потоки (по умолчанию telebot держит свою на каждый поток)
+apihelper.session = requests.Session()
+apihelper.session.mount("https://", HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=64,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=(502, 503, 504)),
+))
+apihelper.CONNECT_TIMEOUT = 3.05
+apihelper.READ_TIMEOUT = 10
+
+
+# =========================
+# TIME (одно "сейчас" на апдейт)
+# =========================
+_NOW: contextvars.ContextVar[Optional[datetime]] = contextvars.ContextVar("now", default=None)
+
+class NowMiddleware(BaseMiddleware):
+    """Фиксирует datetime.now(KZ_TZ) на время обработки одного апдейта."""
+
+    def __init__(self):
+        super().__init__()
+        self.update_types = ["message", "callback_query"]
+
+    def pre_process(self, message, data):
+        data["now_token"] = _NOW.set(datetime.now(KZ_TZ))
+
+    def post_process(self, message, data, exception):
+        token = data.get("now_token")
+        if token is not None:
+            _NOW.reset(token)
+
+bot.setup_middleware(NowMiddleware())
+
+def now_kz() -> datetime:
+    # вне апдейта (таймеры, старт) — считаем заново
+    return _NOW.get() or datetime.now(KZ_TZ)
+
+# текущие сутки по KZ: (YYYY-MM-DD, начало дня epoch, начало следующего epoch);
+# пересчитываем только после полуночи, в остальное время — одно сравнение
+_KZ_DAY: Tuple[str, int, int] = ("", 0, 0)
+
+def kz_day() -> Tuple[str, int, int]:
+    global _KZ_DAY
+    day = _KZ_DAY
+    if time.time() >= day[2]:
+        d = datetime.now(KZ_TZ).date()
+        start = int(datetime(d.year, d.month, d.day, tzinfo=KZ_TZ).timestamp())
+        # у KZ фиксированное смещение без перехода на летнее время — в сутках всегда 86400 сек
+        day = _KZ_DAY = (d.isoformat(), start, start + 86400)
+    return day
+
+def today_kz() -> str:
+    return kz_day()[0]
 
 
 # =========================
@@ -51,28 +143,82 @@ WEEK_DAILY_USES = 5
 # =========================
 DB = "data.sqlite3"
 db_lock = threading.Lock()
-
-def db():
-    return sqlite3.connect(DB, check_same_thread=False)
+db_read_lock = threading.Lock()
+
+_WRITE_CONN: Optional[sqlite3.Connection] = None
+_READ_CONN: Optional[sqlite3.Connection] = None
+
+def db() -> sqlite3.Connection:
+    # одно долгоживущее соединение на запись (вызывать под db_lock):
+    # кэш подготовленных запросов живёт вместе с ним, autocommit — без c.commit()
+    global _WRITE_CONN
+    if _WRITE_CONN is None:
+        _WRITE_CONN = sqlite3.connect(DB, check_same_thread=False, cached_statements=256, isolation_level=None)
+        _WRITE_CONN.execute("PRAGMA cache_size=-64000")
+        _WRITE_CONN.execute("PRAGMA mmap_size=268435456")
+        _WRITE_CONN.execute("PRAGMA journal_mode=WAL")
+        _WRITE_CONN.execute("PRAGMA synchronous=NORMAL")
+        _WRITE_CONN.execute("PRAGMA busy_timeout=30000")
+        _WRITE_CONN.execute("PRAGMA temp_store=MEMORY")
+    return _WRITE_CONN
+
+def db_read() -> sqlite3.Connection:
+    # отдельное read-only соединение (вызывать под db_read_lock): в WAL чтения
+    # не ждут писателя. Открывается после init_db — файл базы уже должен быть
+    global _READ_CONN
+    if _READ_CONN is None:
+        _READ_CONN = sqlite3.connect(f"file:{DB}?mode=ro", uri=True, check_same_thread=False, cached_statements=256)
+        _READ_CONN.execute("PRAGMA cache_size=-64000")
+        _READ_CONN.execute("PRAGMA mmap_size=268435456")
+        _READ_CONN.execute("PRAGMA busy_timeout=30000")
+    return _READ_CONN
 
 def init_db():
-    with db_lock, db() as c:
+    with db_lock:
+        c = db()
+        c.execute("BEGIN")
         c.execute("""
-        CREATE TABLE IF NOT EXISTS logs (
+        CREATE TABLE IF NOT EXISTS logs_v2 (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             chat_id INTEGER,
             event TEXT,
             value TEXT,
-            created_at TEXT
+            created_at INTEGER
         )
         """)
+        c.execute("CREATE INDEX IF NOT EXISTS ix_logs_v2 ON logs_v2(chat_id, event, created_at)")
+        # старая таблица logs хранила created_at ISO-строкой — переносим в epoch и удаляем
+        if c.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='logs'").fetchone():
+            c.execute("""
+            INSERT INTO logs_v2(id, chat_id, event, value, created_at)
+            SELECT id, chat_id, event, value, CAST(strftime('%s', created_at) AS INTEGER) FROM logs
+            """)
+            c.execute("DROP TABLE logs")
         c.execute("""
         CREATE TABLE IF NOT EXISTS subscriptions (
             chat_id INTEGER PRIMARY KEY,
             plan TEXT NOT NULL,
-            expires_at TEXT NOT NULL
+            expires_at INTEGER NOT NULL
         )
         """)
+        # в старой схеме expires_at объявлен TEXT: ISO-строки, а epoch из set_sub SQLite
+        # тоже хранит строкой. Пересоздаём таблицу с INTEGER, переводя значения в epoch
+        cols = {row[1]: row[2] for row in c.execute("PRAGMA table_info(subscriptions)")}
+        if cols.get("expires_at", "").upper() != "INTEGER":
+            rows = c.execute("SELECT chat_id, plan, expires_at FROM subscriptions").fetchall()
+            c.execute("""
+            CREATE TABLE subscriptions_v2 (
+                chat_id INTEGER PRIMARY KEY,
+                plan TEXT NOT NULL,
+                expires_at INTEGER NOT NULL
+            )
+            """)
+            c.executemany(
+                "INSERT INTO subscriptions_v2(chat_id, plan, expires_at) VALUES(?,?,?)",
+                [(chat_id, plan, expires_to_epoch(exp)) for chat_id, plan, exp in rows],
+            )
+            c.execute("DROP TABLE subscriptions")
+            c.execute("ALTER TABLE subscriptions_v2 RENAME TO subscriptions")
         c.execute("""
         CREATE TABLE IF NOT EXISTS users (
             chat_id INTEGER PRIMARY KEY,
@@ -81,159 +227,350 @@ def init_db():
             created_at TEXT
         )
         """)
-        c.commit()
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS sessions (
+            chat_id INTEGER PRIMARY KEY,
+            data TEXT NOT NULL,
+            updated_at INTEGER NOT NULL
+        )
+        """)
+        c.execute("COMMIT")
+
+def warm_up_db():
+    # подтягиваем в кэш страницы горячих таблиц до первого апдейта
+    with db_read_lock:
+        c = db_read()
+        for table in ("logs_v2", "subscriptions", "users", "sessions"):
+            c.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchall()
 
 def now_iso() -> str:
-    return datetime.now(KZ_TZ).isoformat()
+    return now_kz().isoformat()
+
+def expires_to_epoch(value) -> int:
+    # epoch (int или строка из цифр) оставляем как есть, ISO-строку разбираем
+    if isinstance(value, int) or str(value).isdigit():
+        return int(value)
+    return iso_to_epoch(value)
+
+def iso_to_epoch(value: str) -> int:
+    try:
+        dt = datetime.fromisoformat(value)
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=KZ_TZ)
+        return int(dt.timestamp())
+    except Exception:
+        return 0
+
+SQL_INSERT_LOG = "INSERT INTO logs_v2(chat_id,event,value,created_at) VALUES(?,?,?,?)"
+SQL_COUNT_EVENTS = """
+    SELECT COUNT(*) FROM logs_v2
+    WHERE chat_id=? AND event=? AND created_at>=? AND created_at<?
+"""
+
+# логи пишет один фоновый поток пачками — хендлер только кладёт строку в очередь
+LOG_BATCH_MAX = 500
+LOG_FLUSH_TICK = 0.05  # сек: даём пачке набраться, прежде чем идти в базу
+log_q: "queue.SimpleQueue[Tuple[int, str, Optional[str], int]]" = queue.SimpleQueue()
+_log_writer: Optional[threading.Thread] = None
+_log_writer_lock = threading.Lock()
+_log_stop = threading.Event()
 
 def log(chat_id: int, event: str, value: Optional[str] = None):
-    with db_lock, db() as c:
-        c.execute(
-            "INSERT INTO logs(chat_id,event,value,created_at) VALUES(?,?,?,?)",
-            (chat_id, event, value, now_iso())
-        )
-        c.commit()
+    global _log_writer
+    if _log_writer is None:
+        with _log_writer_lock:
+            if _log_writer is None:
+                _log_writer = threading.Thread(target=_log_writer_loop, name="log-writer", daemon=True)
+                _log_writer.start()
+    _bump_count(chat_id, event, today_kz())
+    log_q.put_nowait((chat_id, event, value, int(time.time())))
+
+def _drain_logs(timeout: float) -> List[Tuple[int, str, Optional[str], int]]:
+    try:
+        batch = [log_q.get(timeout=timeout)]
+    except queue.Empty:
+        return []
+    while len(batch) < LOG_BATCH_MAX:
+        try:
+            batch.append(log_q.get_nowait())
+        except queue.Empty:
+            break
+    return batch
+
+def _write_logs(batch: List[Tuple[int, str, Optional[str], int]]):
+    # autocommit: пачку явно заворачиваем в одну транзакцию — один коммит WAL на пачку.
+    # IMMEDIATE берёт блокировку на запись сразу, а не на первом INSERT посреди пачки
+    with db_lock:
+        c = db()
+        try:
+            c.execute("BEGIN IMMEDIATE")
+            c.executemany(SQL_INSERT_LOG, batch)
+            c.execute("COMMIT")
+        except Exception:
+            if c.in_transaction:
+                c.execute("ROLLBACK")
+            raise
+
+def _log_writer_loop():
+    while not _log_stop.is_set():
+        batch = _drain_logs(1.0)
+        if not batch:
+            continue
+        if len(batch) < LOG_BATCH_MAX:
+            _log_stop.wait(LOG_FLUSH_TICK)
+            while len(batch) < LOG_BATCH_MAX:
+                try:
+                    batch.append(log_q.get_nowait())
+                except queue.Empty:
+                    break
+        try:
+            _write_logs(batch)
+        except Exception as e:
+            print(f"log writer error: {e!r}")
+
+def flush_logs():
+    # при выходе даём писателю дописать пачку, которую он уже забрал из очереди,
+    # и дописываем всё, что осталось в очереди
+    _log_stop.set()
+    if _log_writer is not None:
+        _log_writer.join(timeout=5)
+    while True:
+        batch = _drain_logs(0)
+        if not batch:
+            return
+        try:
+            _write_logs(batch)
+        except Exception as e:
+            print(f"log flush error: {e!r}")
+            return
+
+atexit.register(flush_logs)
+
+# дневные счётчики в памяти: всё, что залогировано с запуска процесса, считаем сами,
+# а из базы один раз на ключ добираем только строки, записанные до старта
+_BOOT_TS = int(time.time())
+_day_counts: Dict[Tuple[int, str, str], int] = {}
+_day_base: Dict[Tuple[int, str, str], int] = {}
+_counts_day = today_kz()
+_counts_lock = threading.Lock()
+
+def _bump_count(chat_id: int, event: str, day: str):
+    global _counts_day
+    with _counts_lock:
+        if day > _counts_day:
+            # наступили новые сутки — вчерашние ключи больше не нужны
+            _counts_day = day
+            for d in (_day_counts, _day_base):
+                for k in [k for k in d if k[2] < day]:
+                    del d[k]
+        key = (chat_id, event, day)
+        _day_counts[key] = _day_counts.get(key, 0) + 1
 
 def count_today(chat_id: int, event: str) -> int:
-    today = datetime.now(KZ_TZ).date().isoformat()
-    with db_lock, db() as c:
-        cur = c.cursor()
-        cur.execute("""
-            SELECT COUNT(*) FROM logs
-            WHERE chat_id=? AND event=? AND substr(created_at,1,10)=?
-        """, (chat_id, event, today))
-        return int(cur.fetchone()[0])
+    today, start, end = kz_day()
+    key = (chat_id, event, today)
+    with _counts_lock:
+        base = _day_base.get(key)
+        if base is not None:
+            return base + _day_counts.get(key, 0)
+    end = min(end, _BOOT_TS)
+    with db_read_lock:
+        row = db_read().execute(SQL_COUNT_EVENTS, (chat_id, event, start, end)).fetchone()
+    with _counts_lock:
+        base = _day_base.setdefault(key, int(row[0]))
+        return base + _day_counts.get(key, 0)
 
 
 # =========================
 # USERS (name + phone)
 # =========================
+SQL_GET_USER = "SELECT name, phone FROM users WHERE chat_id=?"
+SQL_UPSERT_USER_NAME = """
+    INSERT INTO users(chat_id, name, phone, created_at)
+    VALUES(?,?,NULL,?)
+    ON CONFLICT(chat_id) DO UPDATE SET name=excluded.name
+"""
+SQL_UPSERT_USER_PHONE = """
+    INSERT INTO users(chat_id, name, phone, created_at)
+    VALUES(?,NULL,?,?)
+    ON CONFLICT(chat_id) DO UPDATE SET phone=excluded.phone
+"""
+
 def get_user_profile(chat_id: int) -> Tuple[Optional[str], Optional[str]]:
-    with db_lock, db() as c:
-        cur = c.cursor()
-        cur.execute("SELECT name, phone FROM users WHERE chat_id=?", (chat_id,))
-        row = cur.fetchone()
-        if not row:
-            return (None, None)
-        return (row[0], row[1])
+    with db_read_lock:
+        row = db_read().execute(SQL_GET_USER, (chat_id,)).fetchone()
+    if not row:
+        return (None, None)
+    return (row[0], row[1])
 
 def upsert_user_name(chat_id: int, name: str):
     name = (name or "").strip()
-    with db_lock, db() as c:
-        c.execute("""
-            INSERT INTO users(chat_id, name, phone, created_at)
-            VALUES(?,?,NULL,?)
-            ON CONFLICT(chat_id) DO UPDATE SET name=excluded.name
-        """, (chat_id, name, now_iso()))
-        c.commit()
+    with db_lock:
+        db().execute(SQL_UPSERT_USER_NAME, (chat_id, name, now_iso()))
 
 def upsert_user_phone(chat_id: int, phone: str):
     phone = (phone or "").strip()
-    with db_lock, db() as c:
-        c.execute("""
-            INSERT INTO users(chat_id, name, phone, created_at)
-            VALUES(?,NULL,?,?)
-            ON CONFLICT(chat_id) DO UPDATE SET phone=excluded.phone
-        """, (chat_id, phone, now_iso()))
-        c.commit()
+    with db_lock:
+        db().execute(SQL_UPSERT_USER_PHONE, (chat_id, phone, now_iso()))
 
 
 # =========================
 # SUBSCRIPTIONS
 # =========================
-PLAN_TITLES = {
-    "free": "Free",
-    "day": "Day (пробная)",
-    "week": "Week",
-    "month": "Month",
-    "two_month": "2 Month",
+PlanInfo = namedtuple("PlanInfo", "title days price_kzt daily_limit")
+
+# daily_limit=None — без лимита; days=0 — план нельзя купить
+PLAN: Dict[str, PlanInfo] = {
+    "free": PlanInfo("Free", 0, 0, FREE_DAILY_USES),
+    "day": PlanInfo("Day (пробная)", 1, 299, None),
+    "week": PlanInfo("Week", 7, 399, WEEK_DAILY_USES),
+    "month": PlanInfo("Month", 30, 1499, None),
+    "two_month": PlanInfo("2 Month", 60, 2299, None),
 }
 
-PLAN_DAYS = {
-    "day": 1,
-    "week": 7,
-    "month": 30,
-    "two_month": 60,
-}
-
-PLAN_PRICES_KZT = {
-    "day": 299,
-    "week": 399,
-    "month": 1499,
-    "two_month": 2299,
-}
+def plan_title(plan: str) -> str:
+    p = PLAN.get(plan)
+    return p.title if p else plan
+
+def paid_plan(plan: str) -> Optional[PlanInfo]:
+    p = PLAN.get(plan)
+    return p if p and p.days else None
+
+SQL_GET_SUB = "SELECT plan, expires_at FROM subscriptions WHERE chat_id=?"
+SQL_UPSERT_SUB = """
+    INSERT INTO subscriptions(chat_id, plan, expires_at)
+    VALUES(?,?,?)
+    ON CONFLICT(chat_id) DO UPDATE SET plan=excluded.plan, expires_at=excluded.expires_at
+"""
+
+def get_sub_raw(chat_id: int) -> Tuple[str, int]:
+    """(plan, expires_at epoch) — без разбора дат, для горячего пути."""
+    with db_read_lock:
+        row = db_read().execute(SQL_GET_SUB, (chat_id,)).fetchone()
+    if not row:
+        return ("free", 0)
+    return (row[0], int(row[1]))
 
 def get_sub(chat_id: int) -> Tuple[str, datetime]:
-    with db_lock, db() as c:
-        cur = c.cursor()
-        cur.execute("SELECT plan, expires_at FROM subscriptions WHERE chat_id=?", (chat_id,))
-        row = cur.fetchone()
-        if not row:
-            return ("free", datetime(1970, 1, 1, tzinfo=KZ_TZ))
-        plan, exp = row[0], row[1]
-        try:
-            exp_dt = datetime.fromisoformat(exp)
-            if exp_dt.tzinfo is None:
-                exp_dt = exp_dt.replace(tzinfo=KZ_TZ)
-        except Exception:
-            exp_dt = datetime(1970, 1, 1, tzinfo=KZ_TZ)
-        return (plan, exp_dt)
+    plan, exp = get_sub_raw(chat_id)
+    return (plan, datetime.fromtimestamp(exp, KZ_TZ))
 
 def is_active(plan: str, exp: datetime) -> bool:
     if plan == "free":
         return False
-    return exp > datetime.now(KZ_TZ)
+    return exp > now_kz()
+
+# план спрашивают на каждый клик — держим его в памяти; set_sub сбрасывает запись
+_plan_cache: TTLCache = TTLCache(maxsize=10_000, ttl=60)
+_plan_cache_lock = threading.Lock()
 
+@cached(_plan_cache, key=lambda chat_id: chat_id, lock=_plan_cache_lock)
 def effective_plan(chat_id: int) -> str:
     if chat_id in ADMIN_IDS:
         return "two_month"
-    plan, exp = get_sub(chat_id)
-    return plan if is_active(plan, exp) else "free"
+    plan, exp = get_sub_raw(chat_id)
+    return plan if plan != "free" and exp > time.time() else "free"
 
 def set_sub(chat_id: int, plan: str, days: int):
-    exp = datetime.now(KZ_TZ) + timedelta(days=days)
-    with db_lock, db() as c:
-        c.execute("""
-            INSERT INTO subscriptions(chat_id, plan, expires_at)
-            VALUES(?,?,?)
-            ON CONFLICT(chat_id) DO UPDATE SET plan=excluded.plan, expires_at=excluded.expires_at
-        """, (chat_id, plan, exp.isoformat()))
-        c.commit()
+    exp = now_kz() + timedelta(days=days)
+    with db_lock:
+        db().execute(SQL_UPSERT_SUB, (chat_id, plan, int(exp.timestamp())))
+    with _plan_cache_lock:
+        _plan_cache.pop(chat_id, None)
     log(chat_id, "sub_set", f"{plan}|{exp.isoformat()}")
 
 def can_use_today(chat_id: int) -> Tuple[bool, str]:
     if chat_id in ADMIN_IDS:
         return True, ""
 
-    plan = effective_plan(chat_id)
-    used = count_today(chat_id, "focus")
-
-    if plan in ("month", "two_month", "day"):
+    p = PLAN.get(effective_plan(chat_id), PLAN["free"])
+    if p.daily_limit is None:
         return True, ""
 
-    if plan == "week":
-        if used < WEEK_DAILY_USES:
-            return True, ""
-        return False, (
-            "⛔ Лимит на сегодня исчерпан.\n"
-            f"План: <b>{PLAN_TITLES[plan]}</b>\n"
-            f"Лимит: <b>{WEEK_DAILY_USES}</b> раз/день."
-        )
-
-    if used < FREE_DAILY_USES:
+    if count_today(chat_id, "focus") < p.daily_limit:
         return True, ""
+    times = "раза" if p.daily_limit in (2, 3, 4) else "раз"
     return False, (
         "⛔ Лимит на сегодня исчерпан.\n"
-        f"План: <b>{PLAN_TITLES['free']}</b>\n"
-        f"Лимит: <b>{FREE_DAILY_USES}</b> раза/день."
+        f"План: <b>{p.title}</b>\n"
+        f"Лимит: <b>{p.daily_limit}</b> {times}/день."
     )
 
 
 # =========================
-# SESSION MEMORY + TIMERS
+# SESSION MEMORY
 # =========================
-user_data: Dict[int, Dict[str, Any]] = {}
-timers: Dict[int, Dict[str, Optional[threading.Timer]]] = {}
+MAX_CHATS = 50_000
+
+class LRU(OrderedDict):
+    """dict с вытеснением самых давно тронутых ключей сверх maxsize."""
+
+    def __init__(self, maxsize: int, on_evict=None):
+        super().__init__()
+        self.maxsize = maxsize
+        self.on_evict = on_evict
+        self._touched: Dict[Any, float] = {}
+        self._lock = threading.RLock()
+
+    def __getitem__(self, key):
+        with self._lock:
+            value = super().__getitem__(key)
+            self.move_to_end(key)
+            self._touched[key] = time.monotonic()
+            return value
+
+    def get(self, key, default=None):
+        with self._lock:
+            return self[key] if key in self else default
+
+    def peek(self, key, default=None):
+        # без обновления порядка
+        return OrderedDict.get(self, key, default)
+
+    def setdefault(self, key, default=None):
+        with self._lock:
+            if key in self:
+                return self[key]
+            self[key] = default
+            return default
+
+    def pop(self, key, *default):
+        with self._lock:
+            self._touched.pop(key, None)
+            return super().pop(key, *default)
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            super().__setitem__(key, value)
+            self.move_to_end(key)
+            self._touched[key] = time.monotonic()
+            evicted = self._evict_front(lambda: len(self) > self.maxsize)
+        self._notify(evicted)
+
+    def expire(self, max_idle: float):
+        # порядок = порядок касаний, поэтому просроченные лежат в начале
+        cutoff = time.monotonic() - max_idle
+        with self._lock:
+            evicted = self._evict_front(lambda: bool(self) and self._touched.get(next(iter(self)), 0) < cutoff)
+        self._notify(evicted)
+
+    def _evict_front(self, should_evict) -> List[Tuple[Any, Any]]:
+        evicted = []
+        while should_evict():
+            k, v = self.popitem(last=False)
+            self._touched.pop(k, None)
+            evicted.append((k, v))
+        return evicted
+
+    def _notify(self, evicted: List[Tuple[Any, Any]]):
+        if self.on_evict:
+            for k, v in evicted:
+                self.on_evict(k, v)
+
+def _on_session_evict(chat_id: int, _):
+    mark_session_dirty(chat_id)  # сессии больше нет — при сбросе удалится и из базы
+
+user_data: Dict[int, Dict[str, Any]] = LRU(MAX_CHATS, on_evict=_on_session_evict)
 
 CRITERIA: List[Tuple[str, str]] = [
     ("influence", "Влияние (польза для результата)"),
@@ -249,8 +586,8 @@ HINTS = {
     "meaning":   "1 = не важно, 5 = очень важно для тебя",
 }
 
-def reset_session(chat_id: int):
-    user_data[chat_id] = {
+def reset_session(chat_id: int) -> Dict[str, Any]:
+    data = user_data[chat_id] = {
         "step": "idle",
         "energy_now": None,
         "energy_msg_id": None,
@@ -259,34 +596,175 @@ def reset_session(chat_id: int):
         "cur_action": 0,
         "cur_crit": 0,
         "expected_type_msg_id": None,
-        "answered_type_msgs": set(),
         "expected_score_msg_id": None,
-        "answered_score_msgs": set(),
-        "focus": None,
-        "focus_type": None,
+        "focus_action": None,  # выбранное действие целиком (name/type/scores)
         "result_msg_id": None,
         "result_locked": False,
     }
+    return data
+
+def session_step(chat_id: int) -> Optional[str]:
+    # для фильтров хендлеров: один поиск в user_data вместо "in" + [...]
+    data = user_data.get(chat_id)
+    return data.get("step") if data else None
+
 
-def cancel_timer(chat_id: int, key: str):
-    t = timers.get(chat_id, {}).get(key)
-    if t:
+# =========================
+# SCHEDULER (один поток на все таймеры вместо threading.Timer на каждый)
+# =========================
+_TIMER_HEAP: List[Tuple[float, int, Any]] = []
+_timer_cv = threading.Condition()
+_timer_seq = itertools.count()
+_scheduler_thread: Optional[threading.Thread] = None
+# колбэки ходят в Telegram — выполняем их не в потоке планировщика,
+# чтобы медленный send_message не задерживал остальные сроки
+_timer_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="timer")
+
+def _run_scheduled(fn):
+    try:
+        fn()
+    except Exception as e:
+        print(f"timer error: {e!r}")
+
+def _scheduler_loop():
+    while True:
+        with _timer_cv:
+            while True:
+                now = time.time()
+                if _TIMER_HEAP and _TIMER_HEAP[0][0] <= now:
+                    break
+                timeout = min(_TIMER_HEAP[0][0] - now, 60) if _TIMER_HEAP else 60
+                _timer_cv.wait(timeout)
+            due = []
+            while _TIMER_HEAP and _TIMER_HEAP[0][0] <= now:
+                due.append(heapq.heappop(_TIMER_HEAP)[2])
+
+        for fn in due:
+            _timer_pool.submit(_run_scheduled, fn)
+
+def call_later(delay: float, fn):
+    global _scheduler_thread
+    with _timer_cv:
+        if _scheduler_thread is None:
+            _scheduler_thread = threading.Thread(target=_scheduler_loop, name="scheduler", daemon=True)
+            _scheduler_thread.start()
+        heapq.heappush(_TIMER_HEAP, (time.time() + delay, next(_timer_seq), fn))
+        _timer_cv.notify()
+
+# чаты, молчащие больше суток, выметаем и без давления на MAX_CHATS
+SESSION_IDLE_TTL = 24 * 3600
+SESSION_SWEEP_EVERY = 600
+
+def sweep_sessions():
+    try:
+        user_data.expire(SESSION_IDLE_TTL)
+        retired_msgs.expire(SESSION_IDLE_TTL)
+    finally:
+        call_later(SESSION_SWEEP_EVERY, sweep_sessions)
+
+
+# =========================
+# OUTBOX (исходящие, ответ на которые не нужен, — через очередь с лимитами Telegram)
+# =========================
+GLOBAL_SEND_RATE = 30      # сообщений в секунду на весь бот
+CHAT_SEND_INTERVAL = 1.0   # секунд между сообщениями в один чат
+
+outbox: "queue.Queue[Tuple[str, Dict[str, Any]]]" = queue.Queue()
+_outbox_thread: Optional[threading.Thread] = None
+_outbox_lock = threading.Lock()
+
+# чаты, где бот заблокирован/удалён: не шлём, пока пользователь сам не напишет
+dead_chats: set[int] = set()
+
+def mark_chat_dead(chat_id: int):
+    dead_chats.add(chat_id)
+
+def is_chat_gone(e: ApiTelegramException) -> bool:
+    if e.error_code == 403:
+        return True
+    return e.error_code == 400 and "chat not found" in (e.description or "").lower()
+
+def send_later(method: str, **kwargs):
+    """Ставит bot.<method>(**kwargs) в очередь; kwargs обязательно с chat_id."""
+    global _outbox_thread
+    if kwargs["chat_id"] in dead_chats:
+        return
+    with _outbox_lock:
+        if _outbox_thread is None:
+            _outbox_thread = threading.Thread(target=_outbox_loop, name="outbox", daemon=True)
+            _outbox_thread.start()
+    outbox.put((method, kwargs))
+
+def _postpone_chat(deferred: list, chat_id: int, first: tuple, until: float) -> float:
+    """Сдвигает first и всё остальное этого чата на until+ — порядок сообщений сохраняется.
+    Возвращает следующий свободный слот чата."""
+    same = [first] + sorted((e for e in deferred if e[3]["chat_id"] == chat_id), key=lambda e: e[1])
+    deferred[:] = [e for e in deferred if e[3]["chat_id"] != chat_id]
+    slot = until
+    for _, seq, method, kwargs in same:
+        deferred.append((slot, seq, method, kwargs))
+        slot += CHAT_SEND_INTERVAL
+    heapq.heapify(deferred)
+    return slot
+
+def _outbox_loop():
+    # deferred — куча (слот, seq, method, kwargs): слот выдаётся при постановке,
+    # поэтому порядок внутри одного чата сохраняется
+    deferred: List[Tuple[float, int, str, Dict[str, Any]]] = []
+    next_slot: Dict[int, float] = {}
+    sent_ts: deque = deque()
+    seq = itertools.count()
+
+    while True:
+        timeout = max(0.0, deferred[0][0] - time.time()) if deferred else None
         try:
-            t.cancel()
-        except Exception:
+            method, kwargs = outbox.get(timeout=timeout)
+            now = time.time()
+            chat_id = kwargs["chat_id"]
+            slot = max(now, next_slot.get(chat_id, 0.0))
+            next_slot[chat_id] = slot + CHAT_SEND_INTERVAL
+            heapq.heappush(deferred, (slot, next(seq), method, kwargs))
+            if len(next_slot) > 10_000:
+                next_slot = {k: v for k, v in next_slot.items() if v > now}
+        except queue.Empty:
             pass
-    timers.setdefault(chat_id, {})[key] = None
 
-def cancel_all_timers(chat_id: int):
-    cancel_timer(chat_id, "check")
-    cancel_timer(chat_id, "remind")
-    cancel_timer(chat_id, "support")
+        while deferred and deferred[0][0] <= time.time():
+            item = heapq.heappop(deferred)
+            _, _, method, kwargs = item
+            chat_id = kwargs["chat_id"]
+            if chat_id in dead_chats:
+                continue
+
+            # глобальный лимит: не больше GLOBAL_SEND_RATE отправок за последнюю секунду
+            now = time.time()
+            while sent_ts and now - sent_ts[0] >= 1.0:
+                sent_ts.popleft()
+            if len(sent_ts) >= GLOBAL_SEND_RATE:
+                time.sleep(1.0 - (now - sent_ts[0]))
+                sent_ts.popleft()
+            sent_ts.append(time.time())
+
+            try:
+                getattr(bot, method)(**kwargs)
+            except ApiTelegramException as e:
+                if e.error_code == 429:
+                    # не спим в потоке: откладываем только этот чат на retry_after
+                    retry_after = (e.result_json.get("parameters") or {}).get("retry_after", 1)
+                    next_slot[chat_id] = _postpone_chat(deferred, chat_id, item, time.time() + retry_after)
+                elif is_chat_gone(e):
+                    mark_chat_dead(chat_id)
+                else:
+                    print(f"outbox {method} error: {e!r}")
+            except Exception as e:
+                print(f"outbox {method} error: {e!r}")
 
 
 # =========================
 # UI
 # =========================
-MENU_TEXTS = {
+# тексты кнопок главного меню; сверяем с _txt(m) — текстом без пробелов по краям
+MENU_TEXTS = frozenset({
     "🚀 Начать действие",
     "⭐ Premium",
     "👤 Профиль",
@@ -294,16 +772,16 @@ MENU_TEXTS = {
     "❓ Как пользоваться",
     "💳 Оплатил / Отправить чек",
     "⬅️ Назад в меню",
-}
+})
 
-def menu_kb():
+def _build_menu_kb():
     kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
     kb.row("🚀 Начать действие", "⭐ Premium")
     kb.row("📊 Статистика", "👤 Профиль")
     kb.row("❓ Как пользоваться")
     return kb
 
-def payment_kb():
+def _build_payment_kb():
     kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
     kb.row("💳 Оплатил / Отправить чек", "⭐ Premium")
     kb.row("🚀 Начать действие")
@@ -311,13 +789,13 @@ def payment_kb():
     kb.row("❓ Как пользоваться")
     return kb
 
-def contact_kb():
+def _build_contact_kb():
     kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
     kb.add(types.KeyboardButton("📱 Поделиться контактом", request_contact=True))
     kb.add(types.KeyboardButton("⬅️ Назад в меню"))
     return kb
 
-def energy_kb():
+def _build_energy_kb():
     kb = types.InlineKeyboardMarkup()
     kb.row(
         types.InlineKeyboardButton("🔋 Высокая", callback_data="energy:high"),
@@ -326,10 +804,12 @@ def energy_kb():
     )
     return kb
 
+ENERGY_LABELS = {"high": "🔋 Высокая", "mid": "😐 Средняя", "low": "🪫 Низкая"}
+
 def energy_label(code: str) -> str:
-    return {"high": "🔋 Высокая", "mid": "😐 Средняя", "low": "🪫 Низкая"}.get(code, code)
+    return ENERGY_LABELS.get(code, code)
 
-def type_kb():
+def _build_type_kb():
     kb = types.InlineKeyboardMarkup()
     kb.row(
         types.InlineKeyboardButton("🧠 Умственное", callback_data="type:mental"),
@@ -341,26 +821,28 @@ def type_kb():
     )
     return kb
 
+TYPE_LABELS = {
+    "mental": "🧠 Умственное",
+    "physical": "💪 Физическое",
+    "routine": "🗂 Рутинное",
+    "social": "💬 Общение",
+}
+
 def type_label(t: Optional[str]) -> str:
-    return {
-        "mental": "🧠 Умственное",
-        "physical": "💪 Физическое",
-        "routine": "🗂 Рутинное",
-        "social": "💬 Общение",
-    }.get(t or "", "—")
-
-def score_kb():
+    return TYPE_LABELS.get(t or "", "—")
+
+def _build_score_kb():
     kb = types.InlineKeyboardMarkup(row_width=5)
     kb.add(*[types.InlineKeyboardButton(str(i), callback_data=f"score:{i}") for i in range(1, 6)])
     return kb
 
-def result_kb(plan: str):
+def _build_result_kb(premium: bool):
     kb = types.InlineKeyboardMarkup()
     kb.add(
         types.InlineKeyboardButton("🚀 Я начал", callback_data="res:start"),
         types.InlineKeyboardButton("⏸ Отложить 10 минут", callback_data="res:delay10"),
     )
-    if plan in ("two_month", "month", "day"):
+    if premium:
         kb.add(
             types.InlineKeyboardButton("🕒 Попозже (30 минут)", callback_data="res:delay30"),
             types.InlineKeyboardButton("❌ Не хочу сейчас", callback_data="res:skip"),
@@ -369,7 +851,7 @@ def result_kb(plan: str):
         kb.add(types.InlineKeyboardButton("❌ Не хочу сейчас", callback_data="res:skip"))
     return kb
 
-def premium_menu_kb():
+def _build_premium_menu_kb():
     kb = types.InlineKeyboardMarkup()
     kb.add(types.InlineKeyboardButton("🟢 Day (299₸)", callback_data="buy:day"))
     kb.add(types.InlineKeyboardButton("🟡 Week (399₸)", callback_data="buy:week"))
@@ -377,52 +859,237 @@ def premium_menu_kb():
     kb.add(types.InlineKeyboardButton("🔴 2 Month (2299₸)", callback_data="buy:two_month"))
     return kb
 
+# планы, которым доступно "Попозже (30 минут)"
+DELAY30_PLANS = frozenset({"two_month", "month", "day"})
+
+# клавиатуры без состояния — собираем и сериализуем один раз:
+# telebot отдаёт строку в reply_markup как есть, без повторного to_json()
+MENU_KB = _build_menu_kb().to_json()
+PAYMENT_KB = _build_payment_kb().to_json()
+CONTACT_KB = _build_contact_kb().to_json()
+ENERGY_KB = _build_energy_kb().to_json()
+TYPE_KB = _build_type_kb().to_json()
+SCORE_KB = _build_score_kb().to_json()
+PREMIUM_MENU_KB = _build_premium_menu_kb().to_json()
+REMOVE_KB = types.ReplyKeyboardRemove().to_json()
+RESULT_KB_PREMIUM = _build_result_kb(premium=True).to_json()
+RESULT_KB_FREE = _build_result_kb(premium=False).to_json()
+
+def result_kb(plan: str):
+    return RESULT_KB_PREMIUM if plan in DELAY30_PLANS else RESULT_KB_FREE
+
 
 # =========================
 # MANUAL PAY (NO OCR) — чек → админу → approve/reject + 10–15 sec delay
 # =========================
 PENDING_PAYMENTS: Dict[int, Dict[str, Any]] = {}  # user_id -> {"plan":..., "ts":..., "receipt_ts":..., "review_delay":...}
 
-def admin_review_kb(user_id: int, plan: str):
+# заявка (user_id, ts выбора плана) решается ровно один раз — даже если админ
+# успел нажать второй раз, пока идёт задержка перед активацией
+_processed_payments: TTLCache = TTLCache(maxsize=100_000, ttl=86400)
+_processed_payments_lock = threading.Lock()
+
+def claim_payment(user_id: int, pending: Dict[str, Any]) -> bool:
+    key = (user_id, pending["ts"])
+    with _processed_payments_lock:
+        if key in _processed_payments:
+            return False
+        _processed_payments[key] = 1
+    return True
+
+def admin_review_kb(user_id: int, plan: str) -> str:
+    # уходит всем админам — сериализуем один раз на чек, а не на каждую отправку
     kb = types.InlineKeyboardMarkup()
     kb.add(
         types.InlineKeyboardButton("✅ Подтвердить", callback_data=f"admin:approve:{user_id}:{plan}"),
         types.InlineKeyboardButton("❌ Отклонить", callback_data=f"admin:reject:{user_id}:{plan}")
     )
-    return kb
+    return kb.to_json()
 
-def manual_payment_text(plan_code: str) -> str:
-    price = PLAN_PRICES_KZT.get(plan_code, 0)
-    plan_title = PLAN_TITLES.get(plan_code, plan_code)
+def _build_manual_payment_text(plan_code: str) -> str:
+    p = PLAN.get(plan_code)
     return (
         "💳 <b>Оплата по реквизиту</b>\n\n"
-        f"План: <b>{plan_title}</b>\n"
-        f"Сумма: <b>{price} ₸</b>\n\n"
+        f"План: <b>{plan_title(plan_code)}</b>\n"
+        f"Сумма: <b>{p.price_kzt if p else 0} ₸</b>\n\n"
         "📌 <b>Реквизит (карта):</b>\n"
         f"<code>{CARD_REQUISITES}</code>\n\n"
         "После оплаты нажми <b>💳 Оплатил / Отправить чек</b> и пришли чек (фото или PDF)."
     )
 
+# текст оплаты зависит только от плана — собираем для всех платных планов заранее
+MANUAL_PAYMENT_TEXTS = {code: _build_manual_payment_text(code) for code, p in PLAN.items() if p.days}
+
+def manual_payment_text(plan_code: str) -> str:
+    return MANUAL_PAYMENT_TEXTS.get(plan_code) or _build_manual_payment_text(plan_code)
+
 
 # =========================
 # SCORING HELPERS (упрощенно, оставил твою логику)
 # =========================
-def energy_weight(level: str) -> float:
-    return {"low": 2.0, "mid": 1.0, "high": 0.6}.get(level, 1.0)
+ENERGY_WEIGHTS = {"low": 2.0, "mid": 1.0, "high": 0.6}
+
+# influence*2 + urgency*2 + meaning + (6 - energy)*ew, умноженное на 5: веса целые
+# (0.6*5 = 3) и сравнение точное; общий сдвиг 6*ew на выбор не влияет и отброшен
+def _score_weights(ew: float) -> Tuple[int, int, int, int]:
+    return (10, 10, -round(ew * 5), 5)
+
+SCORE_WEIGHTS = {level: _score_weights(ew) for level, ew in ENERGY_WEIGHTS.items()}
+DEFAULT_SCORE_WEIGHTS = _score_weights(1.0)
 
 def pick_best_local(data: Dict[str, Any]) -> Dict[str, Any]:
-    lvl = data.get("energy_now", "mid")
-    ew = energy_weight(lvl)
-    best = None
-    best_score = -10**9
-    for a in data["actions"]:
-        s = a["scores"]
-        energy_bonus = 6 - s["energy"]
-        total = (s["influence"] * 2 + s["urgency"] * 2 + s["meaning"] * 1 + energy_bonus * ew)
-        if total > best_score:
-            best_score = total
-            best = a
-    return best
+    # scores: (influence, urgency, energy, meaning) — порядок как в CRITERIA
+    wi, wu, we, wm = SCORE_WEIGHTS.get(data.get("energy_now", "mid"), DEFAULT_SCORE_WEIGHTS)
+    return max(
+        data["actions"],
+        key=lambda a: wi * a["scores"][0] + wu * a["scores"][1] + we * a["scores"][2] + wm * a["scores"][3],
+    )
+
+
+# =========================
+# PER-CHAT QUEUES (внутри чата — по порядку, разные чаты — параллельно)
+# =========================
+# фиксированный набор потоков, у каждого своя очередь; чат всегда попадает в одну и ту же
+# (chat_id % CHAT_WORKERS), так что порядок внутри чата сохраняется, а потоков не больше N
+CHAT_WORKERS = max(1, int(os.getenv("CHAT_WORKERS") or 8))
+
+_chat_queues: List["queue.SimpleQueue[Tuple[int, types.Update]]"] = [queue.SimpleQueue() for _ in range(CHAT_WORKERS)]
+_chat_workers_started = False
+_chat_workers_lock = threading.Lock()
+
+def update_chat_id(update: types.Update) -> Optional[int]:
+    msg = update.message or update.edited_message
+    if msg:
+        return msg.chat.id
+    call = update.callback_query
+    if call:
+        return call.message.chat.id if call.message else call.from_user.id
+    return None
+
+def _chat_worker(q: "queue.SimpleQueue[Tuple[int, types.Update]]"):
+    while True:
+        chat_id, update = q.get()
+        try:
+            bot.dispatch_update(update)
+        except Exception as e:
+            print(f"update {update.update_id} error: {e!r}")
+        finally:
+            mark_session_dirty(chat_id)
+
+def enqueue_update(chat_id: int, update: types.Update):
+    global _chat_workers_started
+    if not _chat_workers_started:
+        with _chat_workers_lock:
+            if not _chat_workers_started:
+                for i, q in enumerate(_chat_queues):
+                    threading.Thread(target=_chat_worker, args=(q,), name=f"chat-worker-{i}", daemon=True).start()
+                _chat_workers_started = True
+    dead_chats.discard(chat_id)
+    _chat_queues[chat_id % CHAT_WORKERS].put((chat_id, update))
+
+# =========================
+# SESSION PERSISTENCE (сессии переживают рестарт; пишем пачкой раз в несколько секунд)
+# =========================
+SESSION_FLUSH_EVERY = 5  # сек
+
+SQL_UPSERT_SESSION = """
+    INSERT INTO sessions(chat_id, data, updated_at) VALUES(?,?,?)
+    ON CONFLICT(chat_id) DO UPDATE SET data=excluded.data, updated_at=excluded.updated_at
+"""
+SQL_DELETE_SESSION = "DELETE FROM sessions WHERE chat_id=?"
+
+_dirty_sessions: set[int] = set()
+_dirty_lock = threading.Lock()
+
+def mark_session_dirty(chat_id: int):
+    with _dirty_lock:
+        _dirty_sessions.add(chat_id)
+
+def flush_sessions():
+    global _dirty_sessions
+    with _dirty_lock:
+        dirty, _dirty_sessions = _dirty_sessions, set()
+    if not dirty:
+        return
+    now = int(time.time())
+    upserts, deletes = [], []
+    for chat_id in dirty:
+        data = user_data.peek(chat_id)
+        if data is None:
+            deletes.append((chat_id,))
+            continue
+        try:
+            upserts.append((chat_id, json.dumps(data, ensure_ascii=False), now))
+        except Exception:
+            # сессию как раз меняет поток чата — запишем в следующий раз
+            mark_session_dirty(chat_id)
+    with db_lock:
+        c = db()
+        try:
+            c.execute("BEGIN IMMEDIATE")
+            c.executemany(SQL_UPSERT_SESSION, upserts)
+            c.executemany(SQL_DELETE_SESSION, deletes)
+            c.execute("COMMIT")
+        except Exception:
+            if c.in_transaction:
+                c.execute("ROLLBACK")
+            with _dirty_lock:
+                _dirty_sessions |= dirty
+            raise
+
+def flush_sessions_periodic():
+    try:
+        flush_sessions()
+    except Exception as e:
+        print(f"session flush error: {e!r}")
+    finally:
+        call_later(SESSION_FLUSH_EVERY, flush_sessions_periodic)
+
+def load_sessions():
+    # на старте: поднимаем свежие сессии (от старых к новым — порядок LRU сохраняется),
+    # протухшие удаляем
+    cutoff = int(time.time()) - SESSION_IDLE_TTL
+    with db_lock:
+        c = db()
+        c.execute("DELETE FROM sessions WHERE updated_at<?", (cutoff,))
+        rows = c.execute("SELECT chat_id, data FROM sessions ORDER BY updated_at").fetchall()
+    for chat_id, raw in rows:
+        try:
+            user_data[chat_id] = json.loads(raw)
+        except Exception as e:
+            print(f"session {chat_id} load error: {e!r}")
+
+atexit.register(flush_sessions)
+
+
+# =========================
+# CALLBACK GUARDS
+# =========================
+# повторное нажатие той же кнопки того же сообщения в течение 2 сек — игнорируем
+_recent_taps: TTLCache = TTLCache(maxsize=50_000, ttl=2.0)
+_recent_taps_lock = threading.Lock()
+
+def is_repeat_tap(call) -> bool:
+    key = (call.message.chat.id, call.message.message_id, call.data)
+    with _recent_taps_lock:
+        if key in _recent_taps:
+            return True
+        _recent_taps[key] = 1
+    return False
+
+# сообщения, на вопрос в которых уже ответили: клик по их кнопкам отбиваем в роутере,
+# не заглядывая в сессию (последние RETIRED_PER_CHAT на чат)
+RETIRED_PER_CHAT = 32
+retired_msgs: Dict[int, deque] = LRU(MAX_CHATS)
+
+def retire_msg(chat_id: int, message_id: int):
+    ids = retired_msgs.get(chat_id)
+    if ids is None:
+        ids = retired_msgs[chat_id] = deque(maxlen=RETIRED_PER_CHAT)
+    ids.append(message_id)
+
+def is_retired(call) -> bool:
+    return call.message.message_id in retired_msgs.peek(call.message.chat.id, ())
 
 
 # =========================
@@ -434,72 +1101,64 @@ def send_welcome(chat_id: int):
         "Привет! 👋\n"
         "Я помогу <b>быстро выбрать одно главное действие</b> и аккуратно поддержу.\n\n"
         "Нажми <b>🚀 Начать действие</b>.",
-        reply_markup=menu_kb()
+        reply_markup=MENU_KB
     )
 
 def start_energy_flow(chat_id: int):
     ok, reason = can_use_today(chat_id)
     if not ok:
-        bot.send_message(chat_id, reason, reply_markup=menu_kb())
+        bot.send_message(chat_id, reason, reply_markup=MENU_KB)
         return
 
-    cancel_all_timers(chat_id)
-    reset_session(chat_id)
+    data = reset_session(chat_id)
 
     # onboarding: name -> contact -> energy
     name, phone = get_user_profile(chat_id)
 
     if not name:
-        user_data[chat_id]["step"] = "ask_name"
-        bot.send_message(chat_id, "Давай познакомимся 🙂\nКак тебя зовут?", reply_markup=types.ReplyKeyboardRemove())
+        data["step"] = "ask_name"
+        bot.send_message(chat_id, "Давай познакомимся 🙂\nКак тебя зовут?", reply_markup=REMOVE_KB)
         return
 
     if not phone:
-        user_data[chat_id]["step"] = "ask_contact"
+        data["step"] = "ask_contact"
         bot.send_message(
             chat_id,
             f"Приятно, <b>{name}</b> 🤝\nТеперь поделись контактом кнопкой ниже:",
-            reply_markup=contact_kb()
+            reply_markup=CONTACT_KB
         )
         return
 
     # go to energy
-    user_data[chat_id]["step"] = "energy"
-    bot.send_message(
+    data["step"] = "energy"
+    msg = bot.send_message(
         chat_id,
-        "Отлично 👍\nДавай определим энергию.",
-        reply_markup=menu_kb()
+        "Отлично 👍\nДавай определим энергию.\n\nТвоя энергия сейчас?",
+        reply_markup=ENERGY_KB
     )
-    msg = bot.send_message(chat_id, "Твоя энергия сейчас?", reply_markup=energy_kb())
-    user_data[chat_id]["energy_msg_id"] = msg.message_id
-    user_data[chat_id]["energy_locked"] = False
+    data["energy_msg_id"] = msg.message_id
+    data["energy_locked"] = False
 
 def show_profile(chat_id: int):
     name, phone = get_user_profile(chat_id)
     p, exp = get_sub(chat_id)
-    eff = effective_plan(chat_id)
-    plan_title = PLAN_TITLES.get(eff, eff)
-
-    used_focus = count_today(chat_id, "focus")
-    if eff == "free":
-        limit_text = f"{used_focus}/{FREE_DAILY_USES} сегодня"
-        exp_text = "—"
-    elif eff == "week":
-        limit_text = f"{used_focus}/{WEEK_DAILY_USES} сегодня"
-        exp_text = exp.strftime("%Y-%m-%d %H:%M")
-    else:
+    eff = PLAN.get(effective_plan(chat_id), PLAN["free"])
+
+    if eff.daily_limit is None:
         limit_text = "без лимита"
-        exp_text = exp.strftime("%Y-%m-%d %H:%M") if is_active(p, exp) else "—"
+    else:
+        limit_text = f"{count_today(chat_id, 'focus')}/{eff.daily_limit} сегодня"
+    exp_text = exp.strftime("%Y-%m-%d %H:%M") if is_active(p, exp) else "—"
 
     bot.send_message(
         chat_id,
         "👤 <b>Профиль</b>\n\n"
         f"Имя: <b>{name or '—'}</b>\n"
         f"Телефон: <b>{phone or '—'}</b>\n\n"
-        f"План: <b>{plan_title}</b>\n"
+        f"План: <b>{eff.title}</b>\n"
         f"Активен до: <b>{exp_text}</b>\n"
         f"Лимит действий: <b>{limit_text}</b>\n",
-        reply_markup=menu_kb()
+        reply_markup=MENU_KB
     )
 
 def show_premium(chat_id: int):
@@ -509,50 +1168,55 @@ def show_premium(chat_id: int):
     bot.send_message(
         chat_id,
         "⭐ <b>Premium</b>\n\n"
-        f"Текущий план: <b>{PLAN_TITLES.get(plan, plan)}</b>\n"
+        f"Текущий план: <b>{plan_title(plan)}</b>\n"
         f"Активен до: <b>{exp_text}</b>\n\n"
         "Выбери план:",
-        reply_markup=premium_menu_kb()
+        reply_markup=PREMIUM_MENU_KB
     )
 
+def back_to_menu(chat_id: int):
+    bot.send_message(chat_id, "Ок 👌", reply_markup=MENU_KB)
+
+def wait_receipt(chat_id: int):
+    if chat_id not in PENDING_PAYMENTS:
+        bot.send_message(chat_id, "Сначала выбери план в ⭐ Premium.", reply_markup=MENU_KB)
+        return
+    user_data.setdefault(chat_id, {})["step"] = "wait_receipt"
+    bot.send_message(chat_id, "Ок ✅ Пришли чек сюда (фото или PDF).")
+
+MENU_ACTIONS = {
+    "🚀 Начать действие": start_energy_flow,
+    "👤 Профиль": show_profile,
+    "⭐ Premium": show_premium,
+    "⬅️ Назад в меню": back_to_menu,
+    "💳 Оплатил / Отправить чек": wait_receipt,
+}
+
+def _txt(m) -> str:
+    # текст без пробелов по краям — считаем один раз на сообщение, дальше берём с m
+    txt = getattr(m, "_txt", None)
+    if txt is None:
+        txt = m._txt = (m.text or "").strip()
+    return txt
+
 @bot.message_handler(commands=["start"])
 def cmd_start(m):
     send_welcome(m.chat.id)
 
-@bot.message_handler(func=lambda m: (m.text or "").strip() in MENU_TEXTS)
+@bot.message_handler(func=lambda m: _txt(m) in MENU_TEXTS)
 def menu_handler(m):
-    chat_id = m.chat.id
-    txt = (m.text or "").strip()
-
-    if txt == "🚀 Начать действие":
-        start_energy_flow(chat_id)
-        return
-    if txt == "👤 Профиль":
-        show_profile(chat_id)
-        return
-    if txt == "⭐ Premium":
-        show_premium(chat_id)
-        return
-    if txt == "⬅️ Назад в меню":
-        bot.send_message(chat_id, "Ок 👌", reply_markup=menu_kb())
-        return
-    if txt == "💳 Оплатил / Отправить чек":
-        if chat_id not in PENDING_PAYMENTS:
-            bot.send_message(chat_id, "Сначала выбери план в ⭐ Premium.", reply_markup=menu_kb())
-            return
-        user_data.setdefault(chat_id, {})
-        user_data[chat_id]["step"] = "wait_receipt"
-        bot.send_message(chat_id, "Ок ✅ Пришли чек сюда (фото или PDF).")
-        return
+    action = MENU_ACTIONS.get(_txt(m))
+    if action:
+        action(m.chat.id)
 
 
 # =========================
 # ONBOARDING: NAME
 # =========================
-@bot.message_handler(func=lambda m: m.chat.id in user_data and user_data[m.chat.id].get("step") == "ask_name")
+@bot.message_handler(func=lambda m: session_step(m.chat.id) == "ask_name")
 def ask_name_handler(m):
     chat_id = m.chat.id
-    txt = (m.text or "").strip()
+    txt = _txt(m)
     if not txt:
         bot.send_message(chat_id, "Напиши имя текстом 🙂")
         return
@@ -562,7 +1226,7 @@ def ask_name_handler(m):
 
     upsert_user_name(chat_id, txt)
     user_data[chat_id]["step"] = "ask_contact"
-    bot.send_message(chat_id, f"Отлично, <b>{txt}</b> ✅\nПоделись контактом:", reply_markup=contact_kb())
+    bot.send_message(chat_id, f"Отлично, <b>{txt}</b> ✅\nПоделись контактом:", reply_markup=CONTACT_KB)
 
 # =========================
 # ONBOARDING: CONTACT
@@ -576,19 +1240,18 @@ def contact_handler(m):
 
     phone = (m.contact.phone_number or "").strip()
     if not phone:
-        bot.send_message(chat_id, "Не смог прочитать номер. Попробуй ещё раз.", reply_markup=contact_kb())
+        bot.send_message(chat_id, "Не смог прочитать номер. Попробуй ещё раз.", reply_markup=CONTACT_KB)
         return
 
     upsert_user_phone(chat_id, phone)
-    bot.send_message(chat_id, "✅ Контакт сохранён! Поехали 🚀", reply_markup=menu_kb())
+    bot.send_message(chat_id, "✅ Контакт сохранён! Поехали 🚀", reply_markup=MENU_KB)
     start_energy_flow(chat_id)
 
 
 # =========================
 # ENERGY / ACTIONS / SCORING (оставлено как у тебя, сокращено)
 # =========================
-@bot.callback_query_handler(func=lambda c: c.data.startswith("energy:"))
-def energy_pick(call):
+def energy_pick(call, lvl: str):
     chat_id = call.message.chat.id
     data = user_data.get(chat_id)
     if not data or data.get("step") != "energy":
@@ -601,41 +1264,43 @@ def energy_pick(call):
         bot.answer_callback_query(call.id, "✅ Энергия уже выбрана")
         return
 
-    lvl = call.data.split(":", 1)[1]
     data["energy_now"] = lvl
+    retire_msg(chat_id, call.message.message_id)
     data["energy_locked"] = True
     data["step"] = "actions"
-    try:
-        bot.edit_message_reply_markup(chat_id, call.message.message_id, reply_markup=None)
-    except Exception:
-        pass
     bot.answer_callback_query(call.id, "Ок ✅")
-    bot.send_message(chat_id, "✍️ Напиши <b>минимум 3</b> действия (каждое с новой строки):", reply_markup=menu_kb())
+    # одним запросом: убираем кнопки и превращаем сообщение в следующий вопрос
+    prompt = (
+        f"Энергия: <b>{energy_label(lvl)}</b>\n\n"
+        "✍️ Напиши <b>минимум 3</b> действия (каждое с новой строки):"
+    )
+    try:
+        bot.edit_message_text(prompt, chat_id, call.message.message_id, reply_markup=None)
+    except ApiTelegramException:
+        bot.send_message(chat_id, prompt, reply_markup=MENU_KB)
 
-@bot.message_handler(func=lambda m: m.chat.id in user_data and user_data[m.chat.id].get("step") == "actions")
+@bot.message_handler(func=lambda m: session_step(m.chat.id) == "actions")
 def actions_input(m):
     chat_id = m.chat.id
-    lines = [x.strip() for x in (m.text or "").split("\n") if x.strip()]
+    lines = [x.strip() for x in _txt(m).split("\n") if x.strip()]
     if len(lines) < 3 or len(lines) > 7:
-        bot.send_message(chat_id, "Нужно <b>3–7</b> действий. Каждое с новой строки.", reply_markup=menu_kb())
+        bot.send_message(chat_id, "Нужно <b>3–7</b> действий. Каждое с новой строки.", reply_markup=MENU_KB)
         return
 
     data = user_data[chat_id]
-    data["actions"] = [{"name": a, "type": None, "scores": {}} for a in lines]
+    data["actions"] = [{"name": a, "type": None, "scores": [0] * len(CRITERIA)} for a in lines]
     data["cur_action"] = 0
     data["cur_crit"] = 0
     data["step"] = "typing"
-    data["answered_type_msgs"].clear()
     ask_action_type(chat_id)
 
 def ask_action_type(chat_id: int):
     data = user_data[chat_id]
     a = data["actions"][data["cur_action"]]
-    msg = bot.send_message(chat_id, f"Выбери тип для:\n<b>{a['name']}</b>", reply_markup=type_kb())
+    msg = bot.send_message(chat_id, f"Выбери тип для:\n<b>{a['name']}</b>", reply_markup=TYPE_KB)
     data["expected_type_msg_id"] = msg.message_id
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("type:"))
-def type_pick(call):
+def type_pick(call, t: str):
     chat_id = call.message.chat.id
     data = user_data.get(chat_id)
     if not data or data.get("step") != "typing":
@@ -645,7 +1310,8 @@ def type_pick(call):
         bot.answer_callback_query(call.id, "Это старое сообщение")
         return
 
-    t = call.data.split(":", 1)[1]
+    bot.answer_callback_query(call.id)
+    retire_msg(chat_id, call.message.message_id)
     a = data["actions"][data["cur_action"]]
     a["type"] = t
 
@@ -668,12 +1334,11 @@ def ask_next_score(chat_id: int):
         f"Действие: <b>{a['name']}</b>\n"
         f"Тип: <b>{type_label(a.get('type'))}</b>\n\n"
         f"Оцени: <b>{title}</b>\n<i>{hint}</i>",
-        reply_markup=score_kb()
+        reply_markup=SCORE_KB
     )
     data["expected_score_msg_id"] = msg.message_id
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("score:"))
-def score_pick(call):
+def score_pick(call, raw: str):
     chat_id = call.message.chat.id
     data = user_data.get(chat_id)
     if not data or data.get("step") != "scoring":
@@ -683,10 +1348,14 @@ def score_pick(call):
         bot.answer_callback_query(call.id, "Это старое сообщение")
         return
 
-    score = int(call.data.split(":", 1)[1])
+    if raw not in ("1", "2", "3", "4", "5"):
+        bot.answer_callback_query(call.id, "Ошибка")
+        return
+    bot.answer_callback_query(call.id)
+    retire_msg(chat_id, call.message.message_id)
+    score = int(raw)
     a = data["actions"][data["cur_action"]]
-    key, _ = CRITERIA[data["cur_crit"]]
-    a["scores"][key] = score
+    a["scores"][data["cur_crit"]] = score
 
     data["cur_crit"] += 1
     if data["cur_crit"] >= len(CRITERIA):
@@ -694,7 +1363,8 @@ def score_pick(call):
         data["cur_action"] += 1
         if data["cur_action"] >= len(data["actions"]):
             best = pick_best_local(data)
-            bot.send_message(chat_id, f"🔥 Главное действие:\n<b>{best['name']}</b>", reply_markup=menu_kb())
+            data["focus_action"] = best
+            bot.send_message(chat_id, f"🔥 Главное действие:\n<b>{best['name']}</b>", reply_markup=MENU_KB)
             data["step"] = "idle"
             return
 
@@ -704,11 +1374,9 @@ def score_pick(call):
 # =========================
 # BUY PREMIUM (manual)
 # =========================
-@bot.callback_query_handler(func=lambda c: c.data.startswith("buy:"))
-def buy_handler(call):
+def buy_handler(call, plan: str):
     chat_id = call.message.chat.id
-    plan = call.data.split(":", 1)[1]
-    if plan not in PLAN_DAYS:
+    if not paid_plan(plan):
         bot.answer_callback_query(call.id, "Ошибка")
         return
 
@@ -716,14 +1384,14 @@ def buy_handler(call):
         bot.answer_callback_query(call.id, "Сейчас включен telegram, не manual")
         return
 
+    bot.answer_callback_query(call.id, "Открываю оплату…")
     PENDING_PAYMENTS[chat_id] = {
         "plan": plan,
         "ts": time.time(),
         "receipt_ts": None,
         "review_delay": None,
     }
-    bot.answer_callback_query(call.id, "Ок ✅")
-    bot.send_message(chat_id, manual_payment_text(plan), reply_markup=payment_kb())
+    send_later("send_message", chat_id=chat_id, text=manual_payment_text(plan), reply_markup=PAYMENT_KB)
 
 
 # =========================
@@ -733,13 +1401,14 @@ def buy_handler(call):
 def receipt_handler(m):
     chat_id = m.chat.id
 
-    if chat_id not in user_data or user_data[chat_id].get("step") != "wait_receipt":
+    data = user_data.get(chat_id)
+    if not data or data.get("step") != "wait_receipt":
         return
 
     pending = PENDING_PAYMENTS.get(chat_id)
     if not pending:
-        bot.send_message(chat_id, "Сначала выбери план в ⭐ Premium.", reply_markup=menu_kb())
-        user_data[chat_id]["step"] = "idle"
+        bot.send_message(chat_id, "Сначала выбери план в ⭐ Premium.", reply_markup=MENU_KB)
+        data["step"] = "idle"
         return
 
     plan = pending["plan"]
@@ -757,132 +1426,310 @@ def receipt_handler(m):
         f"User ID: <code>{chat_id}</code>\n"
         f"Имя: <b>{name or '—'}</b>\n"
         f"Телефон: <b>{phone or '—'}</b>\n"
-        f"План: <b>{PLAN_TITLES[plan]}</b>\n"
-        f"Сумма: <b>{PLAN_PRICES_KZT[plan]} ₸</b>\n\n"
+        f"План: <b>{PLAN[plan].title}</b>\n"
+        f"Сумма: <b>{PLAN[plan].price_kzt} ₸</b>\n\n"
         "Нажми кнопку ниже:"
     )
 
+    review_kb = admin_review_kb(chat_id, plan)
     for admin_id in ADMIN_IDS:
-        try:
-            if m.content_type == "photo":
-                bot.send_photo(admin_id, m.photo[-1].file_id, caption=caption, reply_markup=admin_review_kb(chat_id, plan))
-            else:
-                bot.send_document(admin_id, m.document.file_id, caption=caption, reply_markup=admin_review_kb(chat_id, plan))
-        except Exception:
-            pass
+        if m.content_type == "photo":
+            send_later("send_photo", chat_id=admin_id, photo=m.photo[-1].file_id, caption=caption, reply_markup=review_kb)
+        else:
+            send_later("send_document", chat_id=admin_id, document=m.document.file_id, caption=caption, reply_markup=review_kb)
 
-    user_data[chat_id]["step"] = "idle"
+    data["step"] = "idle"
     log(chat_id, "manual_receipt_sent_to_admin", plan)
 
 
 # =========================
 # ADMIN DECISION (approve/reject) with min 10–15 sec
 # =========================
-@bot.callback_query_handler(func=lambda c: c.data.startswith("admin:"))
-def admin_decision(call):
+def admin_reject(admin_id: int, user_id: int, plan: str, p: PlanInfo, pending: Dict[str, Any]):
+    PENDING_PAYMENTS.pop(user_id, None)
+
+    send_later("send_message", chat_id=admin_id, text=f"❌ Отклонено. Пользователь <code>{user_id}</code>.")
+    send_later(
+        "send_message",
+        chat_id=user_id,
+        text="❌ Не удалось подтвердить оплату.\nПроверь чек и попробуй снова.",
+        reply_markup=MENU_KB
+    )
+    log(user_id, "manual_pay_rejected", plan)
+
+def admin_approve(admin_id: int, user_id: int, plan: str, p: PlanInfo, pending: Dict[str, Any]):
+    receipt_ts = pending.get("receipt_ts") or time.time()
+    review_delay = pending.get("review_delay") or random.randint(10, 15)
+
+    elapsed = time.time() - receipt_ts
+    remain = review_delay - elapsed
+
+    def activate_subscription():
+        set_sub(user_id, plan, p.days)
+        PENDING_PAYMENTS.pop(user_id, None)
+
+        send_later(
+            "send_message",
+            chat_id=admin_id,
+            text=f"✅ Подтверждено. Подписка активирована пользователю <code>{user_id}</code>."
+        )
+        send_later(
+            "send_message",
+            chat_id=user_id,
+            text=f"✅ Оплата подтверждена!\nPremium активирован: <b>{p.title}</b>",
+            reply_markup=MENU_KB
+        )
+        log(user_id, "manual_pay_approved", plan)
+
+    if remain > 0:
+        # админу
+        send_later("send_message", chat_id=admin_id, text=f"⏳ Проверка… (подтверждение через ~{int(remain)} сек)")
+
+        # клиенту тоже
+        def notify_client_then_activate():
+            send_later("send_message", chat_id=user_id, text="⏳ Проверка…")
+            activate_subscription()
+
+        call_later(remain, notify_client_then_activate)
+    else:
+        # если 10–15 сек уже прошло — показываем "проверка" и сразу подтверждаем
+        send_later("send_message", chat_id=user_id, text="⏳ Проверка…")
+        activate_subscription()
+
+# сообщения с чеками, у которых уже убрали кнопки (последние CLEARED_PER_ADMIN на админа)
+CLEARED_PER_ADMIN = 16
+cleared_markups: Dict[int, deque] = LRU(64)
+
+# action -> (обработчик, ответ на нажатие)
+ADMIN_ACTIONS = {
+    "reject": (admin_reject, "Ок ❌"),
+    "approve": (admin_approve, "Ок ✅"),
+}
+
+def admin_decision(call, rest: str):
     admin_id = call.message.chat.id
     if admin_id not in ADMIN_IDS:
         bot.answer_callback_query(call.id, "Нет доступа")
         return
 
-    parts = call.data.split(":")
-    if len(parts) < 4:
+    # admin:<action>:<user_id>:<plan>
+    action, _, rest = rest.partition(":")
+    raw_user_id, _, plan = rest.partition(":")
+    if not raw_user_id.isdecimal() or not plan:
         bot.answer_callback_query(call.id, "Ошибка данных")
         return
+    user_id = int(raw_user_id)
 
-    action = parts[1].strip()
-    user_id = int(parts[2].strip())
-    plan = parts[3].strip()
-
-    # убираем кнопки у админа (чтобы не нажали 2 раза)
-    try:
-        bot.edit_message_reply_markup(admin_id, call.message.message_id, reply_markup=None)
-    except Exception:
-        pass
-
+    action_fn, ok_text = ADMIN_ACTIONS.get(action, (None, None))
     pending = PENDING_PAYMENTS.get(user_id)
+    p = paid_plan(plan)
+    claimed = False
     if not pending:
-        bot.answer_callback_query(call.id, "Заявка уже обработана / не найдена")
-        return
-
-    if plan not in PLAN_DAYS:
-        bot.answer_callback_query(call.id, "Неизвестный план")
-        return
+        reply = "Заявка уже обработана / не найдена"
+    elif not p:
+        reply = "Неизвестный план"
+    elif not action_fn:
+        reply = "Неизвестная команда"
+    elif not claim_payment(user_id, pending):
+        reply = "Заявка уже обработана / не найдена"
+    else:
+        reply, claimed = ok_text, True
+    # отвечаем сразу — кнопка перестаёт крутиться, пока идут правка и рассылка
+    bot.answer_callback_query(call.id, reply)
+
+    # убираем кнопки у админа (чтобы не нажали 2 раза) — один раз на сообщение
+    cleared = cleared_markups.get(admin_id)
+    if cleared is None:
+        cleared = cleared_markups[admin_id] = deque(maxlen=CLEARED_PER_ADMIN)
+    if call.message.message_id not in cleared:
+        try:
+            bot.edit_message_reply_markup(admin_id, call.message.message_id, reply_markup=None)
+            cleared.append(call.message.message_id)
+        except ApiTelegramException:
+            # "message is not modified" и т.п. — кнопок уже нет
+            pass
 
-    # ========= REJECT =========
-    if action == "reject":
-        PENDING_PAYMENTS.pop(user_id, None)
+    if claimed:
+        action_fn(admin_id, user_id, plan, p, pending)
 
-        bot.send_message(admin_id, f"❌ Отклонено. Пользователь <code>{user_id}</code>.")
-        bot.send_message(
-            user_id,
-            "❌ Не удалось подтвердить оплату.\nПроверь чек и попробуй снова.",
-            reply_markup=menu_kb()
-        )
-        log(user_id, "manual_pay_rejected", plan)
+# =========================
+# CALLBACK ROUTER (один хендлер, префикс до ":" → функция)
+# =========================
+CALLBACK_HANDLERS = {
+    "energy": energy_pick,
+    "type": type_pick,
+    "score": score_pick,
+    "buy": buy_handler,
+    "admin": admin_decision,
+}
 
-        bot.answer_callback_query(call.id, "Ок ❌")
+@bot.callback_query_handler(func=lambda c: True)
+def callback_router(call):
+    # префикс отрезаем один раз — хендлер получает только аргумент
+    prefix, _, arg = (call.data or "").partition(":")
+    handler = CALLBACK_HANDLERS.get(prefix)
+    if not handler:
+        bot.answer_callback_query(call.id)
         return
+    if is_retired(call):
+        bot.answer_callback_query(call.id, "Это старое сообщение")
+        return
+    if is_repeat_tap(call):
+        bot.answer_callback_query(call.id, "…")
+        return
+    handler(call, arg)
 
-    # ========= APPROVE =========
-    if action == "approve":
-        receipt_ts = pending.get("receipt_ts") or time.time()
-        review_delay = pending.get("review_delay") or random.randint(10, 15)
-
-        elapsed = time.time() - receipt_ts
-        remain = review_delay - elapsed
 
-        def activate_subscription():
-            set_sub(user_id, plan, PLAN_DAYS[plan])
-            PENDING_PAYMENTS.pop(user_id, None)
+# =========================
+# POLLING LOCK (Redis) — второй инстанс ждёт, а не ловит 409
+# =========================
+REDIS_URL = (os.getenv("REDIS_URL") or "").strip()
+POLL_LOCK_KEY = "focusbot:poll_lock"
+POLL_LOCK_TTL = 30
+
+# продлить / снять lock, только если он всё ещё наш
+_LOCK_REFRESH = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('expire', KEYS[1], ARGV[2]) end return 0"
+_LOCK_RELEASE = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0"
+
+def acquire_poll_lock() -> Tuple[Any, threading.Event]:
+    """Ждёт lock в Redis и держит его heartbeat'ом. Возвращает (release, lost):
+    lost взводится, если lock ушёл другому инстансу, — тогда polling уже остановлен.
+    Без REDIS_URL ничего не делает."""
+    lost = threading.Event()
+    if not REDIS_URL:
+        return (lambda: None), lost
+
+    import redis  # нужен только при REDIS_URL
+
+    r = redis.Redis.from_url(REDIS_URL)
+    instance_id = f"{socket.gethostname()}:{os.getpid()}"
+    while not r.set(POLL_LOCK_KEY, instance_id, nx=True, ex=POLL_LOCK_TTL):
+        print("Poll lock is held by another instance, waiting…")
+        time.sleep(5)
+
+    refresh = r.register_script(_LOCK_REFRESH)
+    release = r.register_script(_LOCK_RELEASE)
+    released = threading.Event()
+
+    def heartbeat():
+        last_ok = time.monotonic()
+        while not released.wait(POLL_LOCK_TTL / 3):
+            try:
+                ok = bool(refresh(keys=[POLL_LOCK_KEY], args=[instance_id, POLL_LOCK_TTL]))
+                if ok:
+                    last_ok = time.monotonic()
+            except Exception as e:
+                print(f"poll lock heartbeat error: {e!r}")
+                # Redis недоступен дольше TTL — lock мог истечь и достаться другому
+                ok = time.monotonic() - last_ok < POLL_LOCK_TTL
+            if not ok:
+                print("Poll lock lost, stopping polling")
+                lost.set()
+                break
+        # polling сбрасывает флаг остановки при (пере)запуске — держим его, пока lock не отпустят
+        while lost.is_set() and not released.wait(1):
+            bot.stop_polling()
+
+    def release_lock():
+        released.set()
+        if lost.is_set():
+            return
+        try:
+            release(keys=[POLL_LOCK_KEY], args=[instance_id])
+        except Exception as e:
+            # lock сам истечёт через POLL_LOCK_TTL; не подменяем исходную причину выхода
+            print(f"poll lock release error: {e!r}")
 
-            bot.send_message(admin_id, f"✅ Подтверждено. Подписка активирована пользователю <code>{user_id}</code>.")
-            bot.send_message(
-                user_id,
-                f"✅ Оплата подтверждена!\nPremium активирован: <b>{PLAN_TITLES[plan]}</b>",
-                reply_markup=menu_kb()
-            )
-            log(user_id, "manual_pay_approved", plan)
+    threading.Thread(target=heartbeat, name="poll-lock", daemon=True).start()
+    return release_lock, lost
 
-        if remain > 0:
-            # админу
-            bot.send_message(admin_id, f"⏳ Проверка… (подтверждение через ~{int(remain)} сек)")
 
-            # клиенту тоже
-            def notify_client_then_activate():
-                try:
-                    bot.send_message(user_id, "⏳ Проверка…")
-                except Exception:
-                    pass
-                activate_subscription()
+# =========================
+# WEBHOOK (если задан WEBHOOK_URL — вместо long polling)
+# =========================
+WEBHOOK_URL = (os.getenv("WEBHOOK_URL") or "").strip()  # https://<host>/<path>
+# без секрета любой, кто узнал URL, может прислать поддельный апдейт (в т.ч. admin:approve) —
+# если не задан, генерируем случайный на запуск и отдаём его Telegram в set_webhook
+WEBHOOK_SECRET = (os.getenv("WEBHOOK_SECRET") or "").strip() or secrets.token_urlsafe(32)
+PORT = int(os.getenv("PORT") or 8080)
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        if self.path != (urlparse(WEBHOOK_URL).path or "/"):
+            self.send_response(404)
+            self.end_headers()
+            return
+        if not secrets.compare_digest(
+            (self.headers.get("X-Telegram-Bot-Api-Secret-Token") or "").encode(), WEBHOOK_SECRET.encode()
+        ):
+            self.send_response(403)
+            self.end_headers()
+            return
+        try:
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            update = types.Update.de_json(body.decode("utf-8"))
+        except Exception:
+            self.send_response(400)
+            self.end_headers()
+            return
+        # апдейт уходит в очередь своего чата, Telegram сразу получает 200
+        bot.process_new_updates([update])
+        self.send_response(200)
+        self.end_headers()
 
-            threading.Timer(remain, notify_client_then_activate).start()
-        else:
-            # если 10–15 сек уже прошло — показываем "проверка" и сразу подтверждаем
-            try:
-                bot.send_message(user_id, "⏳ Проверка…")
-            except Exception:
-                pass
-            activate_subscription()
+    def log_message(self, format, *args):
+        pass
 
-        bot.answer_callback_query(call.id, "Ок ✅")
-        return
+def run_webhook():
+    bot.remove_webhook()
+    bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET, drop_pending_updates=True)
+    print(f"Bot started (webhook on :{PORT})")
+    ThreadingHTTPServer(("0.0.0.0", PORT), WebhookHandler).serve_forever()
+
+def run_polling():
+    # после запуска с WEBHOOK_URL вебхук остаётся у Telegram, и getUpdates отдаёт 409
+    bot.remove_webhook()
+    skip_pending = True
+    while True:
+        release_poll_lock, lock_lost = acquire_poll_lock()
+        print("Bot started")
+        try:
+            # как infinity_polling, но после потери lock выходим и ждём его снова
+            while not lock_lost.is_set():
+                try:
+                    bot.polling(non_stop=True, skip_pending=skip_pending, timeout=60, long_polling_timeout=60)
+                    break
+                except Exception as e:
+                    print(f"polling error: {e!r}")
+                    time.sleep(3)
+                finally:
+                    skip_pending = False
+        finally:
+            release_poll_lock()
+        if not lock_lost.is_set():
+            return
 
-    # ========= UNKNOWN =========
-    bot.answer_callback_query(call.id, "Неизвестная команда")
 
 # =========================
 # RUN
 # =========================
+def on_sigterm(signum, frame):
+    # рестарт по Procfile — это SIGTERM, а по умолчанию Python на нём выходит без atexit:
+    # поднимаем SystemExit, чтобы flush_sessions/flush_logs успели дописать базу
+    bot.stop_polling()
+    raise SystemExit(0)
+
 if __name__ == "__main__":
+    signal.signal(signal.SIGTERM, on_sigterm)
     init_db()
-    print("Bot started")
-    try:
-        bot.infinity_polling(skip_pending=True, none_stop=True, timeout=60, long_polling_timeout=60)
-    except ApiTelegramException as e:
-        if "409" in str(e):
-            print("409 conflict: another instance is running. Stop the other instance and restart.")
-            raise
-        raise
+    warm_up_db()
+    load_sessions()
+    call_later(SESSION_SWEEP_EVERY, sweep_sessions)
+    call_later(SESSION_FLUSH_EVERY, flush_sessions_periodic)
+    bot.get_me()  # проверяет токен и открывает keep-alive к api.telegram.org
+    if WEBHOOK_URL:
+        run_webhook()
+    else:
+        run_polling()
 
 